@@ -1,11 +1,21 @@
+import json
 import os
 import os.path
+import selectors
+import shlex
+import shutil
+import stat
 import subprocess
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
 from subprocess import CalledProcessError
+from types import MappingProxyType
 
-from .util import restrict_keys, selective_merge
+from .util import is_private, restrict_keys, selective_merge
 
 DEFAULT_REPO_CONFIG = {
     "storage": {
@@ -19,20 +29,68 @@ DEFAULT_REPO_CONFIG = {
         "keep_weekly": 4,
         "keep_monthly": 3,
         "keep_yearly": 5
-    }
+    },
+    "ssh_multiplexing": False
+}
+
+# command line flags for the supported retention settings, e.g. keep_daily -> --keep-daily
+RETENTION_FLAGS = {
+    name: f"--{name.replace('_', '-')}"
+    for name in DEFAULT_REPO_CONFIG["retention"]
 }
 
+# number of borg warning/error messages to keep around for reporting
+BORG_LOG_TAIL = 64
+REPORTED_LOG_LEVELS = ("WARNING", "ERROR", "CRITICAL")
+
+IS_INTERACTIVE = sys.stdout.isatty()
+
+# resolve borg from PATH only once; if it can't be found, running it fails with the usual error
+BORG_EXECUTABLE = shutil.which("borg") or "borg"
+
+# ssh connection sharing for remote repositories, see borg_environment
+SSH_CONTROL_DIR = "/run/snapborg/ssh"
+SSH_MULTIPLEXING_RSH = (f"ssh -o ControlMaster=auto -o ControlPath={SSH_CONTROL_DIR}/%C "
+                        "-o ControlPersist=60")
+
 
 class BorgRepo:
     def __init__(self, snapper_config: str, repopath: str, compression: str, retention, encryption="none",
-                 passphrase=None):
+                 passphrase=None, ssh_multiplexing=False, exclude_patterns=()):
         self.repopath = repopath
         self.compression = compression
         self.retention = retention
         self.encryption = encryption
         self.passphrase = passphrase
+        self.exclude_patterns = tuple(exclude_patterns)
+        # connection sharing only makes sense for repositories reached via ssh
+        self._ssh_multiplexing = ssh_multiplexing and is_remote_repo(repopath)
+        self._env = None
+        self._env_built = False
         self.snapper_config = snapper_config
-        self.is_interactive = os.isatty(sys.stdout.fileno())
+        self.is_interactive = IS_INTERACTIVE
+        # the part of the borg create invocation which is the same for every archive
+        self._create_args = ("create",
+                             "--one-file-system",
+                             "--stats",
+                             "--exclude-caches",
+                             "--checkpoint-interval", "600",
+                             "--compression", self.compression,
+                             *chain.from_iterable(("--exclude", e) for e in self.exclude_patterns),
+                             *(("--progress",) if self.is_interactive else ()))
+        self._retention_args = retention_args(self.retention)
+
+    def get_env(self, dryrun=False):
+        """
+        Return the environment for borg invocations on this repo. It is only built for
+        invocations which are actually run, so that dry runs don't set anything up.
+        """
+        if dryrun:
+            return None
+        if not self._env_built:
+            self._env = borg_environment(self.passphrase, self._ssh_multiplexing)
+            self._env_built = True
+        return self._env
 
     def init(self, dryrun=False):
         """
@@ -46,24 +104,14 @@ class BorgRepo:
             "--make-parent-dirs",
             self.repopath,
         ]
-        launch_borg(borg_init_invocation, self.passphrase,
+        launch_borg(borg_init_invocation, self.get_env(dryrun),
                     print_output=self.is_interactive, dryrun=dryrun)
 
-    def backup(self, backup_name, path, exclude_patterns=[], timestamp=None, dryrun=False, mount_path=None):
+    def backup(self, backup_name, path, timestamp=None, dryrun=False, mount_path=None):
 
-        borg_create = ["create",
-                       "--one-file-system",
-                       "--stats",
-                       "--exclude-caches",
-                       "--checkpoint-interval", "600",
-                       "--compression", self.compression]
+        borg_create = list(self._create_args)
         if timestamp:
             borg_create += ("--timestamp", timestamp.isoformat())
-        for e in exclude_patterns:
-            borg_create += ("--exclude", e)
-
-        if self.is_interactive:
-            borg_create.append("--progress")
 
         repospec = f"{self.repopath}::{backup_name}"
         args = borg_create + [repospec, '.']
@@ -72,7 +120,7 @@ class BorgRepo:
             with bind_mount(mount_path, path):
                 launch_borg(
                     args,
-                    self.passphrase,
+                    self.get_env(dryrun),
                     print_output=self.is_interactive,
                     dryrun=dryrun,
                     cwd=mount_path,
@@ -80,33 +128,38 @@ class BorgRepo:
         else:
             launch_borg(
                 args,
-                self.passphrase,
+                self.get_env(dryrun),
                 print_output=self.is_interactive,
                 dryrun=dryrun,
                 cwd=path,
             )
 
-    def delete(self, backup_name, dryrun=False):
-        borg_delete = ["delete", f"{self.repopath}::{backup_name}"]
-        launch_borg(borg_delete, self.passphrase,
+    def delete(self, *backup_names, dryrun=False):
+        """
+        Delete the given archives using a single borg invocation
+        """
+        if not backup_names:
+            # borg would delete the whole repository otherwise!
+            return
+        borg_delete = ["delete", self.repopath, *backup_names]
+        launch_borg(borg_delete, self.get_env(dryrun),
                     print_output=self.is_interactive,
                     dryrun=dryrun)
 
     def prune(self, override_retention_settings=None, dryrun=False):
-        override_retention_settings = override_retention_settings or {}
         borg_prune_invocation = ["prune", "--list"]
-        retention_settings = selective_merge(
-            override_retention_settings, self.retention, restrict_keys=True)
-        for name, value in retention_settings.items():
-            borg_prune_invocation += (f"--{name.replace('_', '-')}",
-                                      str(value))
+        if override_retention_settings:
+            borg_prune_invocation += retention_args(selective_merge(
+                override_retention_settings, self.retention, restrict_keys=True))
+        else:
+            borg_prune_invocation += self._retention_args
 
-        borg_prune_invocation += ("--glob-archives", f"'{self.snapper_config}-*'")
+        borg_prune_invocation += ("--glob-archives", f"{self.snapper_config}-*")
         borg_prune_invocation.append(self.repopath)
 
         launch_borg(
             borg_prune_invocation,
-            self.passphrase,
+            self.get_env(dryrun),
             print_output=self.is_interactive,
             dryrun=dryrun
         )
@@ -136,15 +189,56 @@ class BorgRepo:
         else:
             raise Exception("Invalid or unsupported encryption mode given!")
         return cls(snapper_config, borgrepo, compression, retention=retention, encryption=encryption,
-                   passphrase=password)
+                   passphrase=password, ssh_multiplexing=config["ssh_multiplexing"],
+                   exclude_patterns=config.get("exclude_patterns") or ())
 
 
+def retention_args(retention_settings):
+    """
+    Translate the given retention settings into borg prune command line arguments
+    """
+    args = []
+    for name, value in retention_settings.items():
+        flag = RETENTION_FLAGS.get(name) or f"--{name.replace('_', '-')}"
+        args += (flag, str(value))
+    return tuple(args)
+
+
+def run_parallel(configs, fn, max_workers=1):
+    """
+    Call fn for each of the given snapborg configs and return the results in the same order.
+    Configs targeting different borg repositories are processed by up to max_workers threads
+    concurrently, configs sharing a repository still run one after another as borg locks the
+    repository anyway.
+    """
+    if max_workers <= 1:
+        return [fn(config) for config in configs]
+
+    groups = {}
+    for index, config in enumerate(configs):
+        groups.setdefault(config.get("repo"), []).append(index)
+    results = [None] * len(configs)
+
+    def run_group(indices):
+        for index in indices:
+            results[index] = fn(configs[index])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_group, indices) for indices in groups.values()]
+        for future in futures:
+            future.result()
+    return results
+
+
+@lru_cache(maxsize=None)
 def get_password(password):
     """
     Try to read the password from a file, if it looks like a filename.
     Taken from the sftbackup project
+
+    The result is cached, so each passphrase file is only read once per run.
     """
-    if any(password.startswith(char) for char in ('~', '/', '.')):
+    if password.startswith(('~', '/', '.')):
         try:
             password = os.path.expanduser(password)
             with open(password) as pwfile:
@@ -156,38 +250,142 @@ def get_password(password):
     return password
 
 
-def launch_borg(args, password=None, print_output=False, dryrun=False, cwd=None):
+def launch_borg(args, env=None, print_output=False, dryrun=False, cwd=None):
     """
-    launch borg and supply the password by environment
+    launch borg with the given environment (see borg_environment), which is used to supply
+    the password
 
     raises a CalledProcessError when borg doesn't return with 0
     """
 
-    cmd = ["borg"] + args
+    cmd = [BORG_EXECUTABLE] + args
 
     if print_output:
-        print(f"$ {' '.join(cmd)}")
+        print(f"$ {shlex.join(cmd)}")
 
     if not dryrun:
-        env = {'BORG_PASSPHRASE': password} if password else {}
-        # TODO: parse output from JSON log lines
+        # keep preexec_fn, user/group and umask out of these calls: that way CPython spawns
+        # borg using vfork() rather than copying our whole address space with fork()
         try:
             if print_output:
                 subprocess.run(cmd, env=env, check=True, cwd=cwd)
             else:
-                subprocess.check_output(cmd,
-                                        stderr=subprocess.STDOUT,
-                                        env=env,
-                                        cwd=cwd)
+                run_captured([BORG_EXECUTABLE, "--log-json"] + args, env=env, cwd=cwd)
         except CalledProcessError as e:
             if e.returncode == 1:
                 # warning(s) happened, don't raise
                 if not print_output:
-                    print(f"Borg command execution gave warnings:\n{e.output.decode()}")
+                    print(f"Borg command execution gave warnings:\n{e.output}")
             else:
                 raise
 
 
+def borg_environment(password=None, ssh_multiplexing=False):
+    """
+    Return the environment for borg subprocesses, which is None (i.e. inherit our own
+    environment unchanged) unless a passphrase has to be supplied or ssh connections should
+    be shared. The result is read-only so it can be built once and shared by all invocations.
+
+    With ssh_multiplexing, consecutive borg invocations for a remote repository reuse a single
+    ssh master connection instead of doing a full ssh handshake each. A BORG_RSH set by the
+    user always takes precedence, and connections aren't shared if another user could write
+    to the control socket directory.
+    """
+    extra_env = {}
+    if password:
+        extra_env[b"BORG_PASSPHRASE"] = os.fsencode(password)
+    if ssh_multiplexing and b"BORG_RSH" not in os.environb and prepare_ssh_control_dir():
+        extra_env[b"BORG_RSH"] = os.fsencode(SSH_MULTIPLEXING_RSH)
+    if not extra_env:
+        return None
+    env = os.environb.copy()
+    env.update(extra_env)
+    return MappingProxyType(env)
+
+
+def is_remote_repo(repopath):
+    """
+    Return whether the given borg repository is accessed via ssh, i.e. given as an ssh:// URL
+    or in scp style (host:path)
+    """
+    return repopath.startswith("ssh://") or ":" in repopath.split("/", 1)[0]
+
+
+def prepare_ssh_control_dir():
+    """
+    Create the directory for the ssh control sockets if necessary and return whether it can
+    be used, i.e. whether it is a directory no other user can write to
+    """
+    try:
+        os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+        dir_stat = os.lstat(SSH_CONTROL_DIR)
+    except OSError:
+        return False
+    return stat.S_ISDIR(dir_stat.st_mode) and is_private(dir_stat)
+
+
+def run_captured(cmd, env=None, cwd=None):
+    """
+    Run the given borg command (which is expected to emit JSON log lines on stderr) and only
+    keep the most recent warning and error messages instead of its whole output. Anything borg
+    writes to stdout is discarded.
+
+    raises a CalledProcessError carrying those messages when borg doesn't return with 0
+    """
+    messages = deque(maxlen=BORG_LOG_TAIL)
+    with subprocess.Popen(cmd,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE,
+                          env=env,
+                          cwd=cwd) as proc:
+        for line in read_lines(proc.stderr):
+            message = parse_log_line(line)
+            if message is not None:
+                messages.append(message)
+        proc.wait()
+    output = "\n".join(messages)
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd, output=output)
+    return output
+
+
+def parse_log_line(line):
+    """
+    Return the message of a borg JSON log line if it should be reported, None otherwise.
+    Lines which aren't JSON at all are reported verbatim.
+    """
+    if not line.strip():
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return line.decode(errors="replace")
+    if not isinstance(record, dict):
+        return line.decode(errors="replace")
+    if record.get("type") == "log_message" and record.get("levelname") in REPORTED_LOG_LEVELS:
+        return record.get("message")
+    return None
+
+
+def read_lines(stream):
+    """
+    Yield complete lines from the given pipe until it reaches EOF
+    """
+    fd = stream.fileno()
+    pending = b""
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while selector.select():
+            # read from the raw pipe in large chunks, bypassing the per-line buffered reader
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            *lines, pending = (pending + data).split(b"\n")
+            yield from lines
+    if pending:
+        yield pending
+
+
 @contextmanager
 def bind_mount(mount_path, target_path):
     """
@@ -200,11 +398,24 @@ def bind_mount(mount_path, target_path):
         raise Exception("Failed to create bind mount dir; most likely you should re-run this command as root") from exc
 
     # If we didn't properly clean this up in previous invocations
-    while os.path.ismount(mount_path):
-        subprocess.check_call(['umount', mount_path])
+    if is_mounted(mount_path):
+        subprocess.check_call(['umount', '--recursive', mount_path])
 
     subprocess.check_call(['mount', '--bind', target_path, mount_path])
     try:
         yield
     finally:
-        subprocess.check_call(['umount', mount_path])
+        subprocess.check_call(['umount', '--recursive', mount_path])
+
+
+def is_mounted(path):
+    """
+    Check whether anything is mounted at the given path. Unlike os.path.ismount, this also
+    detects bind mounts of directories residing on the same filesystem.
+    """
+    # mount points in mountinfo have whitespace and backslashes escaped as octal sequences
+    mount_point = os.fsencode(os.path.realpath(path))
+    for char in (b"\\", b" ", b"\t", b"\n"):
+        mount_point = mount_point.replace(char, b"\\%03o" % ord(char))
+    with open("/proc/self/mountinfo", "rb") as mountinfo:
+        return any(line.split(b" ", 5)[4] == mount_point for line in mountinfo)
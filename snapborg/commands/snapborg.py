@@ -12,6 +12,9 @@ config usually in /etc/snapborg.yaml
 
 
 import argparse
+import hashlib
+import os
+import os.path
 import re
 import subprocess
 import sys
@@ -19,10 +22,16 @@ from datetime import datetime, timedelta
 
 import yaml
 
-from ..borg import BorgRepo
+from ..borg import BorgRepo, run_parallel
 from ..retention import get_retained_snapshots
-from ..snapper import SnapperConfig
-from ..util import selective_merge
+from ..snapper import SnapperConfig, check_snapper
+from ..util import load_cached, selective_merge, store_cached
+
+# use the libyaml based loader if PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+MAX_AGE_PATTERN = re.compile(r"(\d+)([dh])")
+MAX_AGE_UNIT_HOURS = {"h": 1, "d": 24}
 
 DEFAULT_CONFIG = {
     "configs": []
@@ -43,11 +52,15 @@ def main():
     cli = argparse.ArgumentParser()
     cli.add_argument("--cfg", default="/etc/snapborg.yaml", help="Snapborg config file location")
     cli.add_argument("--dryrun", action="store_true", help="Don't actually execute commands")
+    cli.add_argument("--no-config-cache", action="store_false", dest="config_cache",
+                     help="Parse the config file again instead of using the cached copy")
     cli.add_argument("--bind-mount", action="store_true",
                      help="Bind mount snapshots so that file paths are consistent, which means caching works much "
                           "better. Requires running as root.")
     cli.add_argument("--snapper-config", default=None, dest="snapper_config",
                      help="The name of a snapper config to operate on")
+    cli.add_argument("--jobs", type=int, default=1,
+                     help="Number of borg repositories to operate on concurrently")
     subp = cli.add_subparsers(dest="mode", required=True)
 
     subp.add_parser("prune", help="Prune the borg archives using the retention settings from the "
@@ -68,20 +81,24 @@ def main():
 
     args = cli.parse_args()
 
-    with open(args.cfg, 'r') as stream:
-        cfg = selective_merge(yaml.safe_load(stream), DEFAULT_CONFIG)
+    cfg = load_config(args.cfg, use_cache=args.config_cache, dryrun=args.dryrun)
+    cfg = selective_merge(cfg, DEFAULT_CONFIG)
     configs = get_configs(cfg, args.snapper_config)
 
+    if args.mode in ("backup", "list", "clean-snapper"):
+        # check the snapper version up front, so that a dry run doesn't cache the result
+        check_snapper(dryrun=args.dryrun)
+
     if args.mode == "init":
-        init(cfg, snapper_configs=configs, dryrun=args.dryrun)
+        init(cfg, snapper_configs=configs, dryrun=args.dryrun, jobs=args.jobs)
 
     elif args.mode == "prune":
-        prune(cfg, snapper_configs=configs, dryrun=args.dryrun)
+        prune(cfg, snapper_configs=configs, dryrun=args.dryrun, jobs=args.jobs)
 
     elif args.mode == "backup":
         backup(cfg, snapper_configs=configs, recreate=args.recreate,
                prune_old_backups=not args.no_prune, dryrun=args.dryrun,
-               bind_mount=args.bind_mount)
+               bind_mount=args.bind_mount, jobs=args.jobs)
 
     elif args.mode == "list":
         list_snapshots(cfg, configs=configs)
@@ -93,10 +110,32 @@ def main():
         raise Exception("Unknown program mode")
 
 
+def load_config(path, use_cache=True, dryrun=False):
+    """
+    Parse the given snapborg config file, reusing the cached result of an earlier parse as
+    long as the file hasn't been modified since. In dryrun mode, the cache is not updated.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    # unlike the mtime, the ctime can't be set from userspace and changes on every write or
+    # rename, so copies preserving the mtime and size (cp -p, rsync -t) still invalidate the cache
+    key = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+    cache_name = f"config.{hashlib.sha256(path.encode()).hexdigest()[:16]}.pickle"
+    if use_cache:
+        cfg = load_cached(cache_name, key)
+        if cfg is not None:
+            return cfg
+
+    with open(path, 'r') as stream:
+        cfg = yaml.load(stream, Loader=YAML_LOADER)
+    if not dryrun:
+        store_cached(cache_name, key, cfg)
+    return cfg
+
+
 def list_snapshots(cfg, configs):
     print("Listing snapper snapshots:")
-    for config in configs:
-        snapper_config = SnapperConfig.get(config["name"])
+    for snapper_config in SnapperConfig.get_all(config["name"] for config in configs):
         print(f"\tConfig {snapper_config.name} for subvol {snapper_config.get_path()}:")
         snapshots = snapper_config.get_snapshots()
         for s in snapshots:
@@ -109,43 +148,49 @@ def get_configs(cfg, config_arg=None):
     Check the snapper configs in the snapborg config file and return a list of the
     configs to operate on.
     """
-    configs = cfg["configs"]
-    # every config must have a name
-    if any(not config["name"] for config in configs):
-        raise Exception("Snapper config name must be given for every config section!")
-
-    # duplicate configs are not allowed
-    if len(set(config["name"] for config in configs)) != len(configs):
-        raise Exception("Duplicate config sections found!")
-
-    configs = [selective_merge(c, DEFAULT_CONFIG_PER_REPO) for c in configs]
-    for c in configs:
-        res = re.fullmatch("(\\d+)(d|h)", c["last_backup_max_age"])
+    configs = {}
+    for c in cfg["configs"]:
+        # every config must have a name
+        name = c.get("name")
+        if not name:
+            raise Exception("Snapper config name must be given for every config section!")
+        # duplicate configs are not allowed
+        if name in configs:
+            raise Exception("Duplicate config sections found!")
+
+        c = selective_merge(c, DEFAULT_CONFIG_PER_REPO)
+        res = MAX_AGE_PATTERN.fullmatch(c["last_backup_max_age"])
         if not res:
             raise Exception(
                 "last_backup_max_age must be given as either days (e.g. '5d') or hours (e.g. '6h')")
-        val = int(res.group(1))
-        c["last_backup_max_age"] = timedelta(hours=val if res.group(2) == "h" else val * 24)
+        c["last_backup_max_age"] = timedelta(
+            hours=int(res.group(1)) * MAX_AGE_UNIT_HOURS[res.group(2)])
+        configs[name] = c
 
     if config_arg:
-        configs = [ c for c in configs if c["name"] == config_arg ]
-        if len(configs) == 0:
+        if config_arg not in configs:
             raise ValueError(f"no such config \"{config_arg}\"")
-    return configs
+        return [configs[config_arg]]
+    return list(configs.values())
 
 
 
-def backup(cfg, snapper_configs, recreate, prune_old_backups, dryrun, bind_mount):
+def backup(cfg, snapper_configs, recreate, prune_old_backups, dryrun, bind_mount, jobs=1):
     """
     Backup all given snapper configs, optionally recreating the archives
     """
-    status_map = {}
-    for config in snapper_configs:
+    # the borg repos set up while backing up, reused for pruning afterwards
+    repos = {}
+
+    def backup_with_status(config):
         try:
-            backup_config(config, recreate, dryrun, bind_mount)
-            status_map[config["name"]] = True
+            repos[config["name"]] = backup_config(config, recreate, dryrun, bind_mount)
+            return True
         except Exception as e:
-            status_map[config["name"]] = e
+            return e
+
+    statuses = run_parallel(snapper_configs, backup_with_status, max_workers=jobs)
+    status_map = {config["name"]: status for config, status in zip(snapper_configs, statuses)}
     print("\nBackup results:")
     has_error = False
     for config_name, status in status_map.items():
@@ -158,12 +203,12 @@ def backup(cfg, snapper_configs, recreate, prune_old_backups, dryrun, bind_mount
     if has_error:
         raise Exception("Snapborg failed!")
     elif prune_old_backups:
-        prune(cfg, snapper_configs, dryrun)
+        prune(cfg, snapper_configs, dryrun, jobs=jobs, repos=repos)
 
 
 def backup_config(config, recreate, dryrun, bind_mount):
     """
-    Backup a single snapper config
+    Backup a single snapper config and return the BorgRepo used for it, if any
     """
     name = config["name"]
     print(f"Backing up snapshots for snapper config '{name}'...")
@@ -194,9 +239,8 @@ def backup_config(config, recreate, dryrun, bind_mount):
 
     with snapper_config.prevent_cleanup(snapshots=candidates, dryrun=dryrun):
         results = [ backup_candidate(snapper_config, repo, candidate, recreate,
-                                     config["exclude_patterns"], dryrun=dryrun,
-                                     mount_path=mount_path)
-                for candidate in candidates ]
+                                     dryrun=dryrun, mount_path=mount_path)
+                    for candidate in candidates ]
     has_error = any(not result for result in results)
 
     # possibly accept any error during backup only if fault tolerant mode is active!
@@ -204,8 +248,8 @@ def backup_config(config, recreate, dryrun, bind_mount):
         raise Exception(f"Error(s) while transferring backups for {snapper_config.name}!")
 
     if config["last_backup_max_age"].total_seconds() > 0:
-        # fail if the creation date of the newest snapshot successfully backed up is too old
-        snapshots = snapper_config.get_snapshots()
+        # fail if the creation date of the newest snapshot successfully backed up is too old;
+        # the snapshots fetched above already reflect the backups made during this run
         backed_up = [ s for s in snapshots if s.is_backed_up() ]
         if len(snapshots) > 0 and len(backed_up) == 0:
             raise Exception("No snapshots have been transferred to the borg repo!")
@@ -217,48 +261,70 @@ def backup_config(config, recreate, dryrun, bind_mount):
                 f"Last successful backup for config {snapper_config.name} is from "
                 f"{newest_backed_up.get_date().isoformat()} and thus too old!")
 
+    return repo
+
 
-def backup_candidate(snapper_config, borg_repo, candidate, recreate,
-                     exclude_patterns, dryrun=False, mount_path=None):
+def get_archive_name(snapper_config, snapshot):
+    return f"{snapper_config.name}-{snapshot.get_number()}-{snapshot.get_date().isoformat()}"
+
+
+def backup_candidate(snapper_config, borg_repo, candidate, recreate, dryrun=False,
+                     mount_path=None):
     print(f"Backing up snapshot number {candidate.get_number()} "
           f"from {candidate.get_date().isoformat()}...")
     path_to_backup = candidate.get_path()
-    backup_name = f"{snapper_config.name}-{candidate.get_number()}-{candidate.get_date().isoformat()}"
+    backup_name = get_archive_name(snapper_config, candidate)
     try:
         if recreate:
+            # delete each archive right before recreating it, so an interrupted or failing run
+            # loses at most the archive currently being recreated
             borg_repo.delete(backup_name, dryrun=dryrun)
-            candidate.purge_userdata(dryrun=dryrun)
+            snapper_config.purge_userdata([candidate], dryrun=dryrun)
         borg_repo.backup(backup_name, path_to_backup, timestamp=candidate.get_date_utc(),
-                         exclude_patterns=exclude_patterns, dryrun=dryrun, mount_path=mount_path)
+                         dryrun=dryrun, mount_path=mount_path)
         candidate.set_backed_up(dryrun=dryrun)
         return True
     except subprocess.CalledProcessError as e:
-        print(f"Error backing up snapshot number {candidate.get_number()}!\n\t{e}")
+        print_error(f"Error backing up snapshot number {candidate.get_number()}!", e)
         return False
 
 
-def prune(cfg, snapper_configs, dryrun):
-    for config in snapper_configs:
-        BorgRepo.create_from_config(config).prune(dryrun=dryrun)
+def print_error(message, e):
+    print(f"{message}\n\t{e}")
+    # when not running interactively, this holds the error messages parsed from borg's log
+    if e.output:
+        print("\t" + e.output.replace("\n", "\n\t"))
+
+
+def prune(cfg, snapper_configs, dryrun, jobs=1, repos=None):
+    """
+    Prune the borg archives of all given snapper configs, reusing already set up BorgRepos
+    from the given mapping of config names to repos
+    """
+    repos = repos or {}
+
+    def prune_config(config):
+        repo = repos.get(config["name"]) or BorgRepo.create_from_config(config)
+        repo.prune(dryrun=dryrun)
+
+    run_parallel(snapper_configs, prune_config, max_workers=jobs)
 
 
-def init(cfg, snapper_configs, dryrun):
+def init(cfg, snapper_configs, dryrun, jobs=1):
     """
     Create new borg archives in none or in repokey mode
     """
-    for config in snapper_configs:
-        BorgRepo.create_from_config(config).init(dryrun=dryrun)
+    run_parallel(snapper_configs,
+                 lambda config: BorgRepo.create_from_config(config).init(dryrun=dryrun),
+                 max_workers=jobs)
 
 
 def clean_snapper(cfg, snapper_configs, dryrun):
     """
     Clean snapper userdata from snapborg specific settings
     """
-    for config in snapper_configs:
-        snapper_config = SnapperConfig.get(config["name"])
-        snapshots = snapper_config.get_snapshots()
-        for s in snapshots:
-            s.purge_userdata(dryrun=dryrun)
+    for snapper_config in SnapperConfig.get_all(config["name"] for config in snapper_configs):
+        snapper_config.purge_userdata(dryrun=dryrun)
 
 
 if __name__ == "__main__":
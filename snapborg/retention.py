@@ -1,6 +1,11 @@
+from bisect import bisect_left
 from datetime import datetime, time, timedelta
+from operator import itemgetter
 
-from .util import split
+ONE_MINUTE = timedelta(minutes=1)
+ONE_HOUR = timedelta(hours=1)
+ONE_DAY = timedelta(days=1)
+ONE_WEEK = timedelta(weeks=1)
 
 
 def get_retained_snapshots(snapshots, date_key, keep_last=1, keep_minutely=0, keep_hourly=0,
@@ -13,20 +18,24 @@ def get_retained_snapshots(snapshots, date_key, keep_last=1, keep_minutely=0, ke
     today = now.date()
     start_of_today = datetime.combine(today, time.min)
     retained = set()
-    with_date = sorted([(date_key(snapshot), snapshot)
-                        for snapshot in snapshots], key=lambda entry: entry[0])
+    # evaluate date_key once per snapshot and keep dates and snapshots in two lists sorted by
+    # date, so that the dates can be bisected directly
+    with_date = sorted(((date_key(snapshot), snapshot) for snapshot in snapshots),
+                       key=itemgetter(0))
+    dates = [entry[0] for entry in with_date]
+    sorted_snapshots = [entry[1] for entry in with_date]
     if keep_last > 0:
-        retained.update(it[1] for it in with_date[-keep_last:])
+        retained.update(sorted_snapshots[-keep_last:])
     # Transform each retainment setting (minutely, hourly, ...) into a tuple of the following form:
     # (<snapshots to keep>,
     #  <lambda to calculate (given interval start time) -> (start time of the preceding interval)>
     #  <datetime of the most recent interval>)
     timedeltas = [
-        (keep_minutely, lambda x: x - timedelta(minutes=1),
+        (keep_minutely, lambda x: x - ONE_MINUTE,
          datetime.combine(today, time(now.hour, now.minute))),
-        (keep_hourly, lambda x: x - timedelta(hours=1), datetime.combine(today, time(now.hour))),
-        (keep_daily, lambda x: x - timedelta(days=1), start_of_today),
-        (keep_weekly, lambda x: x - timedelta(weeks=1),
+        (keep_hourly, lambda x: x - ONE_HOUR, datetime.combine(today, time(now.hour))),
+        (keep_daily, lambda x: x - ONE_DAY, start_of_today),
+        (keep_weekly, lambda x: x - ONE_WEEK,
          start_of_today - timedelta(days=today.weekday())),
         (keep_monthly, lambda x: datetime(x.year if x.month != 1 else x.year - 1,
                                           (x.month + 10) % 12 + 1,  # one month earlier
@@ -36,22 +45,18 @@ def get_retained_snapshots(snapshots, date_key, keep_last=1, keep_minutely=0, ke
     # now iterate over all the retainment settings, calculate the corresponding snapshots to be
     # retained and add those to the result set
     for nr_keep, prev_date_fn, first_date in timedeltas:
-        interval = (first_date, now)
-        snapshots_remaining = with_date
-        while nr_keep > 0 and len(snapshots_remaining) > 0:
-            start, end = interval
-            snapshots_to_consider, snapshots_remaining = split(
-                snapshots_remaining, lambda x: x[0] >= start and x[0] < end)
-            # when pruning, borg keeps the last snapshot of an interval. By selecting the last
-            # snapshot here, we ensure we aren't backing up snapshots just to prune them right away
-            # https://borgbackup.readthedocs.io/en/stable/usage/prune.html#description
-            last_snapshot = max(
-                snapshots_to_consider,
-                key=lambda x: x[0],
-                default=None
-            )
-            if last_snapshot is not None:
-                retained.add(last_snapshot[1])
+        start = first_date
+        # as the snapshots are sorted by date, the ones within the current interval are those
+        # from start_index (inclusive) to end_index (exclusive)
+        end_index = bisect_left(dates, now)
+        while nr_keep > 0 and end_index > 0:
+            start_index = bisect_left(dates, start, 0, end_index)
+            if start_index < end_index:
+                # when pruning, borg keeps the last snapshot of an interval. By selecting the last
+                # snapshot here, we ensure we aren't backing up snapshots just to prune them right
+                # away https://borgbackup.readthedocs.io/en/stable/usage/prune.html#description
+                retained.add(sorted_snapshots[end_index - 1])
                 nr_keep -= 1
-            interval = (prev_date_fn(interval[0]), interval[0])
+            end_index = start_index
+            start = prev_date_fn(start)
     return list(retained)
@@ -1,20 +1,47 @@
 import json
+import os
+import shutil
 import subprocess
 from datetime import datetime, timezone
 from contextlib import contextmanager
 
 from packaging import version
 
+from .util import read_cache_file, write_cache_file
+from .version import __version__
 
-def check_snapper():
+# machine readable output requires at least this snapper version
+MIN_SNAPPER_VERSION = version.parse("0.8.6")
+
+# set once the installed snapper version has been checked
+SNAPPER_CHECKED = False
+
+
+def check_snapper(dryrun=False):
     """
-    Snapper version should be >= 0.8.6 to be able to use machine readable output
+    Snapper version should be >= 0.8.6 to be able to use machine readable output.
+    A successful check is cached on disk until the snapper binary or snapborg changes,
+    except in dryrun mode.
     """
+    global SNAPPER_CHECKED
+    executable = shutil.which("snapper")
+    marker = None
+    if executable:
+        stat = os.stat(executable)
+        # a plain marker file holding the identity of the checked binary, nothing is unpickled
+        marker = (f"{executable}\n{stat.st_ino} {stat.st_size} {stat.st_mtime_ns} "
+                  f"{stat.st_ctime_ns}\n{__version__}\n").encode()
+        if read_cache_file("snapper_version_ok") == marker:
+            SNAPPER_CHECKED = True
+            return
     output = subprocess.check_output(["snapper", "--version"]).decode()
-    line = [l for l in output.splitlines() if l.startswith("snapper")][0]
+    line = next(l for l in output.splitlines() if l.startswith("snapper"))
     snapper_version = line.split(" ")[1]
-    if version.parse(snapper_version) < version.parse("0.8.6"):
+    if version.parse(snapper_version) < MIN_SNAPPER_VERSION:
         raise Exception(f"Snapper version {snapper_version} is too old!")
+    if marker is not None and not dryrun:
+        write_cache_file("snapper_version_ok", marker)
+    SNAPPER_CHECKED = True
 
 
 def run_snapper(args, config: str = None, dryrun=False):
@@ -22,22 +49,21 @@ def run_snapper(args, config: str = None, dryrun=False):
     Run a snapper command, optionally for a given config, and return
     the parsed JSON output
     """
-    try:
-        run_snapper.snapper_version_ok
-    except AttributeError:
+    argv_prefix = ("snapper", "-c", config, "--jsonout") if config else ("snapper", "--jsonout")
+    return run_snapper_argv([*argv_prefix, *args], dryrun=dryrun)
+
+
+def run_snapper_argv(argv, dryrun=False):
+    """
+    Run the given complete snapper command line and return the parsed JSON output
+    """
+    if not SNAPPER_CHECKED:
         check_snapper()
-        run_snapper.snapper_version_ok = True
-    args_new = [
-        "snapper",
-        *([] if not config else ["-c", config]),
-        "--jsonout",
-        *args
-    ]
     if dryrun:
-        print(args_new)
+        print(argv)
         return None
     else:
-        output = subprocess.check_output(args_new).decode().strip()
+        output = subprocess.check_output(argv).decode().strip()
         return json.loads(output) if output != "" else None
 
 
@@ -46,6 +72,8 @@ class SnapperConfig:
         self.name = name
         self.settings = settings
         self._snapshots = None
+        self._argv_prefix = ("snapper", "-c", name, "--jsonout")
+        self._snapshots_dir = f"{settings['SUBVOLUME']}/.snapshots"
 
     def is_timeline_enabled(self):
         return self.settings["TIMELINE_CREATE"] == "yes"
@@ -53,20 +81,67 @@ class SnapperConfig:
     def get_path(self):
         return self.settings["SUBVOLUME"]
 
+    def get_snapshots_dir(self):
+        return self._snapshots_dir
+
+    def run(self, *args, dryrun=False):
+        """
+        Run a snapper command for this config and return the parsed JSON output
+        """
+        return run_snapper_argv([*self._argv_prefix, *args], dryrun=dryrun)
+
     def get_snapshots(self):
-        if not self._snapshots:
-            self._snapshots = [
-                SnapperSnapshot(self, info)
-                for info in run_snapper(["list", "--disable-used-space"], self.name)[self.name]
-                # exclude the currently "live" snapshot
-                if info["number"] != 0
-            ]
+        if self._snapshots is None:
+            self._set_snapshots(
+                self.run("list", "--disable-used-space")[self.name])
         return self._snapshots
 
+    def _set_snapshots(self, infos):
+        self._snapshots = [
+            SnapperSnapshot(self, info)
+            for info in infos
+            # exclude the currently "live" snapshot
+            if info["number"] != 0
+        ]
+
     @classmethod
     def get(cls, config_name: str):
         return cls(config_name, run_snapper(["get-config"], config_name))
+
+    @classmethod
+    def get_all(cls, config_names):
+        """
+        Return the configs with the given names. When there are several of them, the
+        snapshots of all configs are listed using a single snapper invocation.
+        """
+        configs = [cls.get(name) for name in config_names]
+        if len(configs) > 1:
+            infos = run_snapper(["list", "--disable-used-space", "--all-configs"])
+            for config in configs:
+                config._set_snapshots(infos[config.name])
+        return configs
     
+    def modify_snapshots(self, snapshots, options, dryrun=False):
+        """
+        Apply the given snapper modify options to all the given snapshots at once
+        """
+        if not snapshots:
+            return
+        self.run("modify", *options, *(f"{s.get_number()}" for s in snapshots), dryrun=dryrun)
+
+    def purge_userdata(self, snapshots=None, dryrun=False):
+        """
+        Remove the snapborg specific user data from the given snapshots (defaults to all
+        snapshots of this config) using a single snapper invocation
+        """
+        if snapshots is None:
+            snapshots = self.get_snapshots()
+        self.modify_snapshots(snapshots, ["--userdata", "snapborg_backup="], dryrun=dryrun)
+        if not dryrun:
+            # keep the in-memory state in line, later max age checks reuse these snapshots
+            for s in snapshots:
+                s._is_backed_up = False
+
     @contextmanager
     def prevent_cleanup(self, snapshots=None, dryrun=False):
         """
@@ -76,37 +151,40 @@ class SnapperConfig:
         if snapshots is None:
             snapshots = self.get_snapshots()
 
-        for s in snapshots:
-            s.prevent_cleanup(dryrun=dryrun)
-        
+        self.modify_snapshots(snapshots, ["--cleanup-algorithm", ""], dryrun=dryrun)
+
         try:
             yield self
         finally:
+            # restore the cleanup algorithms with one snapper call per distinct algorithm
+            by_cleanup = {}
             for s in snapshots:
-                s.restore_cleanup_state(dryrun=dryrun)
+                by_cleanup.setdefault(s.get_cleanup_algorithm(), []).append(s)
+            for cleanup, group in by_cleanup.items():
+                self.modify_snapshots(group, ["--cleanup-algorithm", cleanup], dryrun=dryrun)
 
 
 class SnapperSnapshot:
     def __init__(self, config: SnapperConfig, info):
         self.config = config
         self.info = info
-        if (info["userdata"] or dict()).get("snapborg_backup") == "true":
-            self._is_backed_up = True
-        else:
-            self._is_backed_up = False
+        userdata = info.get("userdata") or {}
+        self._is_backed_up = userdata.get("snapborg_backup") == "true"
         self._cleanup = info["cleanup"]
+        # the snapshot date and number never change, so parse the date only once
+        self._date = datetime.fromisoformat(info["date"])
+        self._path = f"{config.get_snapshots_dir()}/{info['number']}/snapshot"
 
     def get_date(self):
-        return datetime.fromisoformat(self.info["date"])
+        return self._date
 
     def get_date_utc(self):
-        local_time_naive = datetime.fromisoformat(self.info["date"])
-        local_time_aware = local_time_naive.astimezone()
+        local_time_aware = self._date.astimezone()
         utc_time = local_time_aware.astimezone(timezone.utc)
         return utc_time
 
     def get_path(self):
-        return f"{self.config.get_path()}/.snapshots/{self.get_number()}/snapshot"
+        return self._path
 
     def is_backed_up(self):
         return self._is_backed_up
@@ -114,31 +192,10 @@ class SnapperSnapshot:
     def get_number(self):
         return self.info["number"]
 
-    def purge_userdata(self, dryrun=False):
-        run_snapper(
-            ["modify", "--userdata", "snapborg_backup=", f"{self.get_number()}"],
-            self.config.name, dryrun=dryrun)
+    def get_cleanup_algorithm(self):
+        return self._cleanup
 
     def set_backed_up(self, dryrun=False):
-        run_snapper(["modify", "--userdata", "snapborg_backup=true",
-                     f"{self.get_number()}"], self.config.name, dryrun=dryrun)
+        self.config.run("modify", "--userdata", "snapborg_backup=true", f"{self.get_number()}",
+                        dryrun=dryrun)
         self._is_backed_up = True
-
-    def prevent_cleanup(self, dryrun=False):
-        """
-        Prevents this snapshot from being cleaned up
-        """
-
-        run_snapper(
-            ["modify", "--cleanup-algorithm", "", f"{self.get_number()}"],
-            self.config.name, dryrun=dryrun
-        )
-
-    def restore_cleanup_state(self, dryrun=False):
-        """
-        Restores the cleanup algorithm for this snapshot
-        """
-        run_snapper(
-            ["modify", "--cleanup-algorithm", self._cleanup, f"{self.get_number()}"],
-            self.config.name, dryrun=dryrun
-        )
@@ -1,39 +1,50 @@
+import os
+import os.path
+import pickle
+import stat
+
+# snapborg runs as root, so its cache lives in a system location rather than the invoking
+# user's home directory
+CACHE_DIR = "/var/cache/snapborg"
+
+
 def selective_merge(base_obj, delta_obj, restrict_keys=False):
     """
     Recursively merge dict delta_obj into base_obj by adding all key/value
     pairs which don't exist in base_obj yet, optionally removing all keys from
-    base_obj which are not in delta_obj.
+    base_obj which are not in delta_obj. Nested dicts only present in delta_obj
+    are deep copied. Only plain dicts (as produced by the YAML loader) are
+    merged, dict subclasses are treated as values.
     """
-    if not isinstance(base_obj, dict):
+    if type(base_obj) is not dict:
         return base_obj
 
-    delta_keys = set(delta_obj)
-    base_keys = set(base_obj)
-    common_keys = base_keys & delta_keys
-    new_keys = delta_keys - common_keys
-    # only use keys not present in delta_obj if restrict_keys is False
-    base_keys_to_copy = set() if restrict_keys else (base_keys - common_keys)
-
-    ret = {
-        # keys only in base_obj and not in delta_obj
-        **{
-            k: base_obj[k]
-            for k in base_keys_to_copy
-        },
-        # keys in both base_obj and delta_obj
-        **{
-            k: selective_merge(base_obj[k], delta_obj[k], restrict_keys)
-            for k in common_keys
-        },
-        # keys only in delta_obj
-        **{
-            k: delta_obj[k]
-               if not isinstance(delta_obj[k], dict)
-               # make deep copies of nested dicts
-               else selective_merge(dict(), delta_obj[k])
-            for k in new_keys
-        }
-    }
+    ret = {}
+    # merge iteratively: each stack entry fills the result dict of one nesting level
+    stack = [(base_obj, delta_obj, ret, restrict_keys)]
+    while stack:
+        base, delta, out, restrict = stack.pop()
+        if restrict:
+            # keys only in base are dropped, the common ones keep their order from base
+            for k, v in base.items():
+                if k in delta:
+                    out[k] = v
+        else:
+            # start from a shallow copy of base, merged values are overwritten in place below
+            out.update(base)
+        for k, v in delta.items():
+            if k in base:
+                # keys in both base and delta, nested dicts are merged level by level
+                base_value = base[k]
+                if type(base_value) is dict:
+                    out[k] = child = {}
+                    stack.append((base_value, v, child, restrict))
+            elif type(v) is dict:
+                # keys only in delta, make deep copies of nested dicts
+                out[k] = child = {}
+                stack.append(({}, v, child, False))
+            else:
+                out[k] = v
 
     return ret
 
@@ -42,6 +53,9 @@ def restrict_keys(template: dict, target: dict):
     """
     Return a new sub-dict based on target containing only keys which are also present in template
     """
+    if len(template) < len(target):
+        # only probe target for the few keys the template allows
+        return {key: target[key] for key in template if key in target}
     return {
         key: value
         for key, value in target.items()
@@ -49,15 +63,79 @@ def restrict_keys(template: dict, target: dict):
     }
 
 
-def split(data, pred):
+def is_private(stat_result):
     """
-    Partition an iterable in two sublists with the first containing all items for which
-    the given predicate returned True and the second containing all other items
+    Return whether the given file status belongs to the current user and cannot be written
+    by anyone else
     """
-    yes, no = [], []
-    for d in data:
-        if pred(d):
-            yes.append(d)
-        else:
-            no.append(d)
-    return (yes, no)
\ No newline at end of file
+    return stat_result.st_uid == os.geteuid() and not stat_result.st_mode & 0o022
+
+
+def is_private_cache_dir():
+    """
+    Return whether the cache directory is a real directory which is private to the current user
+    """
+    dir_stat = os.lstat(CACHE_DIR)
+    return stat.S_ISDIR(dir_stat.st_mode) and is_private(dir_stat)
+
+
+def read_cache_file(name):
+    """
+    Return the contents of the cache file with the given name, or None if it doesn't exist or
+    it or the cache directory could have been written by another user
+    """
+    try:
+        if not is_private_cache_dir():
+            return None
+        fd = os.open(os.path.join(CACHE_DIR, name), os.O_RDONLY | os.O_NOFOLLOW)
+        with os.fdopen(fd, "rb") as cachefile:
+            if not is_private(os.fstat(cachefile.fileno())):
+                return None
+            return cachefile.read()
+    except OSError:
+        return None
+
+
+def write_cache_file(name, data):
+    """
+    Atomically write the given bytes to the cache file with the given name, readable only by
+    the current user. Failing to write the cache is not an error.
+    """
+    path = os.path.join(CACHE_DIR, name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        if not is_private_cache_dir():
+            return
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, "wb") as cachefile:
+            cachefile.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def load_cached(name, key):
+    """
+    Return the object stored in the cache file with the given name if it was stored for
+    the given key, None otherwise
+    """
+    data = read_cache_file(name)
+    if data is None:
+        return None
+    try:
+        cached_key, obj = pickle.loads(data)
+    except Exception:
+        # a corrupt cache file just means there is nothing cached
+        return None
+    return obj if cached_key == key else None
+
+
+def store_cached(name, key, obj):
+    """
+    Store the given object for the given key in the cache file with the given name
+    """
+    write_cache_file(name, pickle.dumps((key, obj), protocol=pickle.HIGHEST_PROTOCOL))